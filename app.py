@@ -1,13 +1,34 @@
-import click
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify, abort
+
+# Under gunicorn's gevent workers (see Procfile) the stdlib must be patched
+# before anything else touches sockets; the dev-server path skips this.
+if os.environ.get('PRODUCTION'):
+    from gevent import monkey
+    monkey.patch_all()
+
+import click
+import orjson
+from functools import wraps
+from flask import Flask, render_template, request, redirect, url_for, jsonify, abort, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import case, lambda_stmt, select, update
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
 import datetime
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson's C encoder/decoder."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # --- App and Database Configuration ---
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-default-secret-key-for-local-dev')
 
 # Database Connection String for PythonAnywhere (MySQL)
@@ -16,15 +37,41 @@ db_password = os.environ.get('DB_PASSWORD')
 db_hostname = os.environ.get('DB_HOSTNAME')
 db_name = os.environ.get('DB_NAME')
 
+# mysqlclient (MySQLdb) decodes rows in C, roughly 2-3x faster than the
+# pure-Python drivers. gevent deployments should set DB_DRIVER=pymysql,
+# since the C driver's blocking sockets defeat monkey-patching.
+db_driver = os.environ.get('DB_DRIVER', 'mysqldb')
+
 if all([db_username, db_password, db_hostname, db_name]):
     app.config['SQLALCHEMY_DATABASE_URI'] = (
-        f"mysql+mysqlconnector://{db_username}:{db_password}@{db_hostname}/{db_name}"
+        f"mysql+{db_driver}://{db_username}:{db_password}@{db_hostname}/{db_name}"
     )
+    # PythonAnywhere MySQL drops idle connections after ~300s; recycle just
+    # under that and pre-ping so the first query of a request never hits a
+    # stale socket. The bigger pool absorbs bursty login/billing traffic.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+    }
 else:
     # Fallback for local development using SQLite
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///madira.db'
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+if app.debug:
+    # Fail loudly on accidental lazy loads during development so an n+1
+    # regression in a view or template never reaches production quietly.
+    try:
+        from nplusone.ext.flask_sqlalchemy import NPlusOne
+    except ImportError:
+        pass
+    else:
+        app.config['NPLUSONE_RAISE'] = True
+        NPlusOne(app)
+
 db = SQLAlchemy(app)
 
 # --- LOGIN MANAGER SETUP ---
@@ -36,6 +83,29 @@ login_manager.login_view = 'login'
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# argon2id tuned for short interactive logins: 2 passes over 64 MiB, 2 lanes.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+# Verified against when the username is unknown, so login latency doesn't
+# reveal whether an account exists.
+_DUMMY_HASH = password_hasher.hash('madira-dummy-password')
+
+# Where each role lands after logging in.
+ROLE_LANDING = {'superadmin': 'superadmin_dashboard', 'admin': 'sales', 'store': 'billing'}
+
+def require_role(*roles):
+    """Combine login_required with a 403 unless the user holds one of *roles*."""
+    allowed = frozenset(roles)
+    def decorator(view):
+        @wraps(view)
+        @login_required
+        def wrapped(*args, **kwargs):
+            if current_user.role not in allowed:
+                return abort(403)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
 # --- Database Models (Tables) ---
 class Store(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -53,8 +123,15 @@ class User(UserMixin, db.Model):
     role = db.Column(db.String(20), nullable=False)
     store_id = db.Column(db.Integer, db.ForeignKey('store.id'), nullable=True)
 
-    def set_password(self, password): self.password_hash = generate_password_hash(password)
-    def check_password(self, password): return check_password_hash(self.password_hash, password)
+    def set_password(self, password): self.password_hash = password_hasher.hash(password)
+    def check_password(self, password):
+        if not self.password_hash.startswith('$argon2'):
+            # Hash predates the argon2 switch; verify with Werkzeug's pbkdf2.
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except VerificationError:
+            return False
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -66,14 +143,19 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     stock_quantity = db.Column(db.Integer, nullable=False, default=0)
     store_id = db.Column(db.Integer, db.ForeignKey('store.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now(),
+                           onupdate=db.func.now())
+    __table_args__ = (db.Index('ix_product_store_name', 'store_id', 'name'),
+                      db.Index('ix_product_store_stock', 'store_id', 'stock_quantity', 'name'))
     def to_dict(self): return {'id': self.id, 'barcode': self.barcode, 'name': self.name, 'brand': self.brand,'category': self.category, 'size_ml': self.size_ml, 'price': self.price, 'stock_quantity': self.stock_quantity}
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     total_amount = db.Column(db.Float, nullable=False)
-    sale_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    sale_date = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
     store_id = db.Column(db.Integer, db.ForeignKey('store.id'), nullable=False)
-    items = db.relationship('SaleItem', backref='sale', lazy=True, cascade="all, delete-orphan")
+    items = db.relationship('SaleItem', backref='sale', lazy='selectin', cascade="all, delete-orphan")
+    __table_args__ = (db.Index('ix_sale_store_date', store_id, sale_date.desc()),)
 
 class SaleItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -83,21 +165,36 @@ class SaleItem(db.Model):
     price_at_sale = db.Column(db.Float, nullable=False)
     product = db.relationship('Product')
 
+# --- Cached single-row lookups ---
+# lambda_stmt caches the compiled SQL per process, skipping statement
+# construction and compilation on these per-request hot paths.
+def _user_by_username(username):
+    stmt = lambda_stmt(lambda: select(User).where(User.username == username))
+    return db.session.execute(stmt).scalar_one_or_none()
+
 # --- Authentication Routes ---
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        if current_user.role == 'superadmin': return redirect(url_for('superadmin_dashboard'))
-        if current_user.role == 'admin': return redirect(url_for('sales'))
-        else: return redirect(url_for('billing'))
+        return redirect(url_for(ROLE_LANDING.get(current_user.role, 'billing')))
 
     if request.method == 'POST':
-        user = User.query.filter_by(username=request.form['username']).first()
-        if user and user.check_password(request.form['password']):
+        username = request.form.get('username', '')
+        password = request.form.get('password', '')
+        # Reject malformed/bot payloads before spending a DB round-trip.
+        if not username or not password or len(username) > 80:
+            return render_template('login.html', error="Invalid username or password.")
+
+        user = _user_by_username(username)
+        if user and user.check_password(password):
             login_user(user)
-            if user.role == 'superadmin': return redirect(url_for('superadmin_dashboard'))
-            if user.role == 'admin': return redirect(url_for('sales'))
-            else: return redirect(url_for('billing'))
+            return redirect(url_for(ROLE_LANDING.get(user.role, 'billing')))
+        if user is None:
+            # Burn the same verification cost as a real check.
+            try:
+                password_hasher.verify(_DUMMY_HASH, password)
+            except VerificationError:
+                pass
         return render_template('login.html', error="Invalid username or password.")
     return render_template('login.html')
 
@@ -109,19 +206,17 @@ def logout():
 
 # --- Superadmin Routes ---
 @app.route('/superadmin')
-@login_required
+@require_role('superadmin')
 def superadmin_dashboard():
-    if current_user.role != 'superadmin': return abort(403)
-    all_stores = Store.query.order_by(Store.license_validity).all()
     today = datetime.date.today()
-    return render_template('superadmin_dashboard.html', stores=all_stores, today=today)
+    stores = (db.session.query(Store, (Store.license_validity < today).label('expired'))
+              .order_by(Store.license_validity)
+              .paginate(page=request.args.get('page', 1, type=int), per_page=50))
+    return render_template('superadmin_dashboard.html', stores=stores, today=today)
 
 @app.route('/superadmin/update_license/<int:store_id>', methods=['POST'])
-@login_required
+@require_role('superadmin')
 def update_license(store_id):
-    if current_user.role != 'superadmin':
-        return abort(403)
-    
     store = Store.query.get_or_404(store_id)
     new_date_str = request.form.get('new_validity')
     
@@ -157,42 +252,58 @@ def dashboard():
     return render_template('dashboard.html', products=products)
 
 @app.route('/update_stock', methods=['POST'])
-@login_required
+@require_role('store')
 def update_stock():
-    if current_user.role != 'store': return abort(403)
-    product_id = request.form['product_id']
+    product_id = int(request.form['product_id'])
     quantity_to_add = int(request.form['add_stock'])
-    product = Product.query.filter_by(id=product_id, store_id=current_user.store_id).first_or_404()
     if quantity_to_add > 0:
-        product.stock_quantity += quantity_to_add
+        # One UPDATE with a rowcount check instead of SELECT-then-UPDATE.
+        updated = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.store_id == current_user.store_id)
+            .values(stock_quantity=Product.stock_quantity + quantity_to_add),
+            execution_options={'synchronize_session': False}).rowcount
         db.session.commit()
+        if not updated: return abort(404)
     return redirect(url_for('dashboard'))
 
 @app.route('/billing')
-@login_required
+@require_role('store')
 def billing():
-    if current_user.role != 'store': return abort(403)
     return render_template('billing.html')
 
 @app.route('/sales')
-@login_required
+@require_role('admin')
 def sales():
-    if current_user.role != 'admin': return abort(403)
-    all_sales = Sale.query.filter_by(store_id=current_user.store_id).order_by(Sale.sale_date.desc()).all()
+    all_sales = (Sale.query.filter_by(store_id=current_user.store_id)
+                 .order_by(Sale.sale_date.desc()).all())
     return render_template('sales.html', sales=all_sales, store_name=current_user.store.name)
 
 # --- API Endpoints ---
 @app.route('/api/products')
-@login_required
+@require_role('store', 'admin')
 def get_products():
-    if current_user.role not in ['store', 'admin']: return abort(403)
-    products = Product.query.filter(Product.store_id==current_user.store_id, Product.stock_quantity > 0).all()
-    return jsonify([p.to_dict() for p in products])
+    # The billing UI polls this on every scan; answer unchanged catalogs with
+    # a 304 instead of re-querying and re-serializing the whole product list.
+    count, last_change = (db.session.query(db.func.count(Product.id), db.func.max(Product.updated_at))
+                          .filter(Product.store_id == current_user.store_id).one())
+    etag = f"{current_user.store_id}-{count}-{last_change}"
+    if request.if_none_match.contains(etag):
+        return '', 304
+    # Core select + direct orjson dump: no ORM hydration, no to_dict dispatch,
+    # no provider indirection on the hottest read path.
+    rows = db.session.execute(
+        select(Product.id, Product.barcode, Product.name, Product.brand,
+               Product.category, Product.size_ml, Product.price, Product.stock_quantity)
+        .where(Product.store_id == current_user.store_id, Product.stock_quantity > 0)
+    ).mappings().all()
+    response = Response(orjson.dumps([dict(r) for r in rows]), mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/process_bill', methods=['POST'])
-@login_required
+@require_role('store')
 def process_bill():
-    if current_user.role != 'store': return abort(403)
     data = request.get_json()
     bill_items = data.get('items', [])
     if not bill_items: return jsonify({'success': False, 'error': 'Empty bill'}), 400
@@ -202,19 +313,48 @@ def process_bill():
         new_sale = Sale(total_amount=0, store_id=current_user.store_id)
         db.session.add(new_sale)
 
+        # One locked IN-query for the whole bill instead of a SELECT per line
+        # item. Everything from this lock to the commit below runs in the one
+        # session transaction, so InnoDB serializes conflicting bills at row
+        # granularity. Locking in ascending id order keeps two concurrent
+        # bills over the same products from deadlocking each other.
+        ids = sorted({int(item['id']) for item in bill_items})
+        products = {p.id: p for p in Product.query
+                    .filter(Product.store_id == current_user.store_id, Product.id.in_(ids))
+                    .order_by(Product.id)
+                    .with_for_update().all()}
+
+        item_rows = []
+        decrements = {}  # product id -> total quantity sold on this bill
         for item in bill_items:
-            product = Product.query.filter_by(id=item['id'], store_id=current_user.store_id).first()
-            if not product or product.stock_quantity < item['quantity']:
+            product = products.get(int(item['id']))
+            needed = decrements.get(product.id, 0) + item['quantity'] if product else 0
+            if not product or product.stock_quantity < needed:
                 db.session.rollback()
                 return jsonify({'success': False, 'error': f"Not enough stock for {product.name if product else 'ID '+str(item['id'])}"}), 400
-            
-            product.stock_quantity -= item['quantity']
-            sale_item = SaleItem(sale=new_sale, product_id=product.id,
-                                 quantity=item['quantity'], price_at_sale=product.price)
+
+            decrements[product.id] = needed
             total_amount += product.price * item['quantity']
-            db.session.add(sale_item)
-        
+            item_rows.append({'product_id': product.id, 'quantity': item['quantity'],
+                              'price_at_sale': product.price})
+
+        # One UPDATE for every product on the bill; the stock guard in the
+        # WHERE clause makes the decrement atomic even without the row locks.
+        sold = case(decrements, value=Product.id)
+        result = db.session.execute(
+            update(Product)
+            .where(Product.id.in_(decrements), Product.stock_quantity >= sold)
+            .values(stock_quantity=Product.stock_quantity - sold),
+            execution_options={'synchronize_session': False})
+        if result.rowcount != len(decrements):
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Not enough stock'}), 400
+
         new_sale.total_amount = round(total_amount, 2)
+        db.session.flush()  # assigns new_sale.id for the line-item rows
+        for row in item_rows:
+            row['sale_id'] = new_sale.id
+        db.session.bulk_insert_mappings(SaleItem, item_rows)
         db.session.commit()
         return jsonify({'success': True, 'sale_id': new_sale.id})
     except Exception as e: